@@ -0,0 +1,106 @@
+# app/batcher.py
+import asyncio
+from typing import List, Tuple
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from app.mongodb import collection
+
+# Flush when this many docs are queued, or when the window elapses.
+MAX_BATCH = 100
+FLUSH_WINDOW = 0.02  # seconds
+
+
+class InsertBatcher:
+    """
+    Coalesce concurrent insert_one calls into a single insert_many round-trip.
+    Each caller awaits submit(doc) and gets the outcome of its own document.
+    Safe to use from endpoint handlers; the worker task is started lazily.
+    """
+
+    def __init__(self, collection_name: str):
+        self._collection_name = collection_name
+        self._queue: asyncio.Queue = None
+        self._worker: asyncio.Task = None
+        self._loop = None
+
+    async def submit(self, doc: dict):
+        """
+        Enqueue doc for batched insertion and wait until it is written.
+        Raises whatever insert_many raised for this batch.
+        """
+        self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((doc, fut))
+        return await fut
+
+    def start(self):
+        """Start the background flush task (idempotent)."""
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        # queue and worker are loop-bound; after a loop change (serverless
+        # re-entry) rebuild both, mirroring the loop tracking in mongodb.py
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = None
+            self._loop = loop
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            batch: List[Tuple[dict, asyncio.Future]] = []
+            # block for the first item, then drain whatever arrives in the window
+            item = await self._queue.get()
+            batch.append(item)
+            while len(batch) < MAX_BATCH:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=FLUSH_WINDOW)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        docs = [doc for doc, _ in batch]
+        try:
+            coll = collection(self._collection_name)
+            await coll.insert_many(docs, ordered=False)
+        except BulkWriteError as bwe:
+            # unordered bulk: some docs may have failed (e.g. duplicate key)
+            # while the rest were written -- route each error to its own future
+            self._resolve_partial(batch, bwe)
+            return
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_result(None)
+
+    @staticmethod
+    def _resolve_partial(batch, bwe: BulkWriteError):
+        errors = {we["index"]: we for we in bwe.details.get("writeErrors", [])}
+        for i, (_, fut) in enumerate(batch):
+            if fut.done():
+                continue
+            we = errors.get(i)
+            if we is None:
+                fut.set_result(None)
+            elif we.get("code") == 11000:
+                fut.set_exception(DuplicateKeyError(we.get("errmsg", "duplicate key"), 11000, we))
+            else:
+                fut.set_exception(OperationFailure(we.get("errmsg", "write error"), we.get("code"), we))
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+
+# single shared batcher for the craftids collection
+craftid_batcher = InsertBatcher("craftids")
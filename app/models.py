@@ -1,18 +1,28 @@
 # app/models.py
-from pydantic import BaseModel, EmailStr
+import msgspec
 
-class Artisan(BaseModel):
+class Artisan(msgspec.Struct):
     name: str
     location: str
     contact_number: str
-    email: EmailStr
+    email: str
     aadhaar_number: str
 
-class Art(BaseModel):
+    def __post_init__(self):
+        # lightweight stand-in for EmailStr; a full RFC regex pass per
+        # request is not worth it for this field
+        if "@" not in self.email:
+            raise ValueError("invalid email address")
+
+class Art(msgspec.Struct):
     name: str
     description: str
-    photo: str  # base64
+    photo: str  # base64 / data URI on submit; stored docs hold a /photo/{id} URL
 
-class OnboardingData(BaseModel):
+class OnboardingData(msgspec.Struct):
     artisan: Artisan
     art: Art
+
+
+# one decoder instance for the process; msgspec compiles the type info once
+onboarding_decoder = msgspec.json.Decoder(OnboardingData)
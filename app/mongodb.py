@@ -1,60 +1,115 @@
 # app/mongodb.py
 import os
 import asyncio
+import base64
 from typing import Optional
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ReturnDocument
+from bson import ObjectId
+from gridfs.asynchronous import AsyncGridFSBucket
+from pymongo import AsyncMongoClient, ReturnDocument
 from pymongo.errors import ServerSelectionTimeoutError
 
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME", "masterip_db")
 
-# Global client/db objects (may be reused across warm invocations)
-_client: Optional[AsyncIOMotorClient] = None
+# Global client/db objects (singleton, reused across warm invocations)
+_client: Optional[AsyncMongoClient] = None
+_client_loop = None
 _db = None
+_init_lock: Optional[asyncio.Lock] = None
+_init_lock_loop = None
+# uniqueness relies on the art_name_norm index, so we must not serve writes
+# indefinitely without it; flips to True on first successful create_indexes
+_indexes_ready = False
 
 def _make_client():
-    # serverSelectionTimeoutMS ensures we fail fast if DB is unreachable
-    return AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=3000)
+    # pure-asyncio PyMongo client (no Motor thread-pool hop per operation);
+    # small tuned pool: serverless instances serve few concurrent requests,
+    # and the 5s timeouts ensure we fail fast if DB is unreachable
+    return AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=10,
+        minPoolSize=1,
+        connectTimeoutMS=5000,
+        serverSelectionTimeoutMS=5000,
+        retryWrites=True,
+    )
 
 async def ensure_initialized():
     """
-    Ensure global _client and _db are initialized.
-    Safe to call from endpoint handlers in serverless env.
+    Ensure the singleton _client/_db pair is initialized and bound to the
+    running event loop. The warm path is a cheap identity check; the cold
+    path is serialized behind a lock so concurrent first requests share
+    one client.
     """
-    global _client, _db
+    global _client, _client_loop, _db, _init_lock, _init_lock_loop
+
+    loop = asyncio.get_running_loop()
 
-    if _db is not None:
+    # warm path: client exists and belongs to this loop
+    if _db is not None and _client is not None and _client_loop is loop:
+        # index creation may have failed at startup (DB unreachable at boot);
+        # keep retrying until it sticks, else duplicates would go undetected
+        if not _indexes_ready:
+            await create_indexes()
         return
 
     if not MONGO_URI:
         raise RuntimeError("MONGO_URI not set in environment")
 
-    # create client (non-awaitable), then try a quick ping to verify connectivity
-    try:
-        if _client is None:
-            _client = _make_client()
-            # small delay to let client init; optional
-            await asyncio.sleep(0)
-        # quick ping to confirm server reachable
-        await _client.admin.command("ping")
-        _db = _client[DB_NAME]
-    except ServerSelectionTimeoutError as e:
-        # close client on failure to avoid dangling resources
-        try:
-            _client.close()
-        except Exception:
-            pass
-        _client = None
-        raise RuntimeError(f"Cannot connect to MongoDB (timeout). Check MONGO_URI and network. {e}") from e
-    except Exception as e:
-        # any other errors
+    # the lock itself is loop-bound, so recreate it after a loop change
+    if _init_lock is None or _init_lock_loop is not loop:
+        _init_lock = asyncio.Lock()
+        _init_lock_loop = loop
+
+    async with _init_lock:
+        # re-check under the lock; another coroutine may have finished init
+        if _db is not None and _client is not None and _client_loop is loop:
+            return
+
+        # stale client from a previous loop (serverless re-entry): drop it
+        if _client is not None:
+            _client = None
+            _client_loop = None
+            _db = None
+
         try:
-            _client.close()
-        except Exception:
-            pass
-        _client = None
-        raise RuntimeError(f"MongoDB init error: {e}") from e
+            _client = _make_client()
+            _client_loop = loop
+            # quick ping to confirm server reachable
+            await _client.admin.command("ping")
+            _db = _client[DB_NAME]
+        except ServerSelectionTimeoutError as e:
+            await _close_quietly()
+            raise RuntimeError(f"Cannot connect to MongoDB (timeout). Check MONGO_URI and network. {e}") from e
+        except Exception as e:
+            await _close_quietly()
+            raise RuntimeError(f"MongoDB init error: {e}") from e
+
+        if not _indexes_ready:
+            await create_indexes()
+
+async def _close_quietly():
+    global _client, _client_loop, _db
+    client, _client, _client_loop, _db = _client, None, None, None
+    try:
+        if client is not None:
+            await client.close()
+    except Exception:
+        pass
+
+async def create_indexes():
+    """
+    Create the indexes the app relies on. Idempotent; retried from
+    ensure_initialized until it succeeds once.
+    """
+    global _indexes_ready
+    if _db is None:
+        raise RuntimeError("Database not initialized")
+    # uniqueness of product names is enforced here instead of a pre-insert find
+    await _db["craftids"].create_index("art_name_norm", unique=True)
+    # get-products sorts newest-first; index so it isn't an in-memory sort
+    await _db["craftids"].create_index([("timestamp", -1)])
+    _indexes_ready = True
 
 def collection(name: str):
     """
@@ -71,19 +126,113 @@ async def next_sequence(name: str) -> int:
     if _db is None:
         raise RuntimeError("Database not initialized")
     counters = _db["counters"]
+    # maxTimeMS so the server aborts a stuck increment instead of us
+    # cancelling client-side while it keeps running
     doc = await counters.find_one_and_update(
         {"_id": name},
         {"$inc": {"seq": 1}},
         upsert=True,
-        return_document=ReturnDocument.AFTER
+        return_document=ReturnDocument.AFTER,
+        maxTimeMS=4000
     )
     return int(doc["seq"])
 
-def close():
-    global _client, _db
+def photo_bucket() -> AsyncGridFSBucket:
+    """
+    GridFS bucket for art photos. Must call ensure_initialized() first.
+    """
+    if _db is None:
+        raise RuntimeError("Database not initialized")
+    return AsyncGridFSBucket(_db, bucket_name="photos")
+
+async def store_photo(photo: str) -> str:
+    """
+    Persist a base64 (or data-URI) photo in GridFS and return a /photo/{id}
+    reference to store on the doc instead of the blob itself. Values that
+    are already URLs/references pass through unchanged.
+    """
+    if photo.startswith(("http://", "https://", "/photo/")):
+        return photo
+    if photo.startswith("data:"):
+        header, _, b64 = photo.partition(",")
+        mime = header[5:].split(";")[0] or "application/octet-stream"
+    else:
+        mime, b64 = "application/octet-stream", photo
+    try:
+        raw = base64.b64decode(b64, validate=True)
+    except Exception:
+        # not decodable base64; keep the original value inline rather than fail
+        return photo
+    oid = await photo_bucket().upload_from_stream(
+        "photo", raw, metadata={"contentType": mime}
+    )
+    return f"/photo/{oid}"
+
+async def delete_photo(ref: str):
+    """
+    Best-effort removal of a stored /photo/{id} file, for when the insert
+    that would have referenced it fails (e.g. duplicate name). Pass-through
+    URLs and undecodable refs are ignored.
+    """
+    if not ref.startswith("/photo/"):
+        return
     try:
-        if _client:
-            _client.close()
-    finally:
-        _client = None
-        _db = None
+        await photo_bucket().delete(ObjectId(ref.rsplit("/", 1)[1]))
+    except Exception:
+        # cleanup must not mask the caller's duplicate/error handling
+        pass
+
+class SeqAllocator:
+    """
+    Hand out sequence numbers from a locally reserved block. When the block
+    is exhausted, one find_one_and_update reserves `chunk` more ids, so the
+    per-create counter round-trip is amortized chunk:1. Unused ids from a
+    block are simply skipped on restart (public ids stay unique, gaps are
+    fine).
+    """
+
+    def __init__(self, name: str, chunk: int = 100):
+        self._name = name
+        self._chunk = chunk
+        self._current = 0
+        self._end = 0  # exclusive
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop = None
+
+    async def next(self) -> int:
+        if _db is None:
+            raise RuntimeError("Database not initialized")
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        async with self._lock:
+            if self._current >= self._end:
+                doc = await _db["counters"].find_one_and_update(
+                    {"_id": self._name},
+                    {"$inc": {"seq": self._chunk}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                    maxTimeMS=4000
+                )
+                top = int(doc["seq"])
+                self._current = top - self._chunk + 1
+                self._end = top + 1
+            seq = self._current
+            self._current += 1
+            return seq
+
+
+# shared allocator for craftid public ids
+craftid_seq = SeqAllocator("craftid_seq")
+
+def close():
+    global _client, _client_loop, _db
+    client, _client, _client_loop, _db = _client, None, None, None
+    if client is not None:
+        # AsyncMongoClient.close() is a coroutine; schedule it if we can
+        try:
+            asyncio.get_running_loop().create_task(client.close())
+        except RuntimeError:
+            # no running loop: just drop the reference
+            pass
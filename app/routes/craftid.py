@@ -1,121 +1,144 @@
 # app/routes/craftid.py
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 import os
+import msgspec
 import hashlib
+import json
 import jwt
+from calendar import timegm
 from datetime import datetime, timedelta
-import asyncio
+from functools import lru_cache
 
-from app.models import OnboardingData
-from app.mongodb import ensure_initialized, collection, next_sequence, close as mongo_close
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout
+
+from app.models import onboarding_decoder
+from app.mongodb import ensure_initialized, craftid_seq, store_photo, delete_photo
+from app.batcher import craftid_batcher
 
 router = APIRouter()
 SECRET_KEY = os.getenv("SECRET_KEY", "change_in_prod")
 ALGORITHM = "HS256"
 
+# one configured signer for the process; jwt.encode() rebuilds a PyJWS and
+# re-resolves the algorithm class through its registry on every call
+_JWS = jwt.PyJWS()
+_SIGN_KEY = SECRET_KEY.encode()
+
+# response link templates, built once instead of f-strings per request
+_VERIFY_URL = "/verify/{pid}"
+_QR_CODE_URL = "/verify/qr/{pid}"
+_TRACK_STATUS_URL = "/status/{tx}"
+_SHOP_LISTING_URL = "/shop/{pid}"
+
+
+def _today_plus_365() -> datetime:
+    # round to midnight so the expiry (and the cache key below) is stable all day
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today + timedelta(days=365)
+
+
+@lru_cache(maxsize=4096)
+def _encode_jwt(public_id: str) -> str:
+    # signing is compute-bound; cache so retries/duplicate calls skip the HMAC
+    payload = json.dumps(
+        {"public_id": public_id, "exp": timegm(_today_plus_365().utctimetuple())},
+        separators=(",", ":"),
+    ).encode()
+    return _JWS.encode(payload, _SIGN_KEY, algorithm=ALGORITHM)
+
 
 async def ensure_db_ready_or_502():
     """
-    Helper: ensure db is ready. If first attempt fails, reset client and retry.
+    Helper: ensure the singleton client is ready (warm path is a cheap check).
     Raises HTTPException(status_code=502) on failure.
     """
     try:
         await ensure_initialized()
     except Exception as e:
-        # attempt to recover by closing client and retrying
-        try:
-            mongo_close()
-            await ensure_initialized()
-        except Exception as e2:
-            # return a 502 so caller can surface to client
-            raise HTTPException(status_code=502, detail=f"DB init error: {e}; retry failed: {e2}")
+        # return a 502 so caller can surface to client
+        raise HTTPException(status_code=502, detail=f"DB init error: {e}")
 
 
 @router.post("/create")
-async def create_craftid(data: OnboardingData):
-    # ensure DB is initialized (with recovery)
-    await ensure_db_ready_or_502()
+async def create_craftid(request: Request):
+    # decode the body with msgspec (C-level parse + validate in one pass)
+    # instead of FastAPI's Pydantic machinery
+    try:
+        data = onboarding_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-    coll = collection("craftids")
+    # ensure DB is initialized (singleton; no-op on warm invocations)
+    await ensure_db_ready_or_502()
 
     art_name_norm = data.art.name.strip().lower()
+    # uniqueness is enforced by the unique index on art_name_norm; a duplicate
+    # surfaces as DuplicateKeyError on insert, saving a find_one round-trip here
 
-    # check uniqueness
-    try:
-        existing = await asyncio.wait_for(coll.find_one({"art_name_norm": art_name_norm}), timeout=4)
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="DB read timed out")
-    except Exception as e:
-        # if this error occurs, try a recovery once (covers rare closed-loop mid-request)
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            coll = collection("craftids")
-            existing = await asyncio.wait_for(coll.find_one({"art_name_norm": art_name_norm}), timeout=4)
-        except Exception as e2:
-            raise HTTPException(status_code=500, detail=f"DB read error: {e}; recovery error: {e2}")
-
-    if existing:
-        raise HTTPException(
-            status_code=409,
-            detail="A similar product name already exists. Please provide a more unique name."
-        )
-
-    # allocate atomic sequence
+    # allocate from the local id block (one counter round-trip per 100 ids)
     try:
-        seq = await asyncio.wait_for(next_sequence("craftid_seq"), timeout=4)
+        seq = await craftid_seq.next()
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="DB sequence allocation timed out")
     except Exception as e:
-        # try recovery once
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            seq = await asyncio.wait_for(next_sequence("craftid_seq"), timeout=4)
-        except Exception as e2:
-            raise HTTPException(status_code=502, detail=f"Failed to allocate public id: {e}; recovery: {e2}")
+        raise HTTPException(status_code=502, detail=f"Failed to allocate public id: {e}")
 
     public_id = f"CID-{seq:05d}"
 
-    payload = {"public_id": public_id, "exp": datetime.utcnow() + timedelta(days=365)}
-    private_key = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    private_key = _encode_jwt(public_id)
+
+    # hash fields incrementally; concatenating first would copy the (possibly
+    # multi-MB) base64 photo twice per request
+    h = hashlib.sha256()
+    h.update(data.art.name.encode())
+    h.update(data.art.description.encode())
+    h.update(data.art.photo.encode())
+    public_hash = h.hexdigest()
 
-    public_hash = hashlib.sha256(
-        (data.art.name + data.art.description + data.art.photo).encode()
-    ).hexdigest()
+    # serialize once; the doc and the response share the same dump and the
+    # base64 photo makes a second recursive pass expensive
+    dumped = msgspec.to_builtins(data)
+    # photo goes to GridFS; the doc only stores the /photo/{id} reference
+    dumped["art"]["photo"] = await store_photo(data.art.photo)
+
+    # capture the clock once; doc, transaction id and response share it
+    now = datetime.utcnow()
+    ts = now.isoformat() + "Z"
+    transaction_id = "tx_" + now.strftime("%Y%m%d%H%M%S")
 
     doc = {
         "public_id": public_id,
         "private_key": private_key,
         "public_hash": public_hash,
         "art_name_norm": art_name_norm,
-        "original_onboarding_data": data.dict(),
-        "timestamp": datetime.utcnow().isoformat() + "Z"
+        "original_onboarding_data": dumped,
+        "timestamp": ts
     }
 
     try:
-        await coll.insert_one(doc)
+        # batched write: coalesced with concurrent requests into one insert_many
+        await craftid_batcher.submit(doc)
+    except DuplicateKeyError:
+        # the photo was uploaded before the insert; don't leave it orphaned
+        await delete_photo(dumped["art"]["photo"])
+        raise HTTPException(
+            status_code=409,
+            detail="A similar product name already exists. Please provide a more unique name."
+        )
     except Exception as e:
-        # try recovery once if insert fails with event-loop closed style errors
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            coll = collection("craftids")
-            await coll.insert_one(doc)
-        except Exception as e2:
-            raise HTTPException(status_code=500, detail=f"DB insert error: {e}; recovery: {e2}")
-
-    transaction_id = "tx_" + datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        raise HTTPException(status_code=500, detail=f"DB insert error: {e}")
 
     response_data = {
         "status": "success",
         "message": f"Your CraftID for '{data.art.name}' has been created successfully.",
         "transaction_id": transaction_id,
-        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "timestamp": ts,
         "verification": {
             "public_id": public_id,
             "private_key": private_key,
             "public_hash": public_hash,
-            "verification_url": f"/verify/{public_id}",
-            "qr_code_link": f"/verify/qr/{public_id}"
+            "verification_url": _VERIFY_URL.format(pid=public_id),
+            "qr_code_link": _QR_CODE_URL.format(pid=public_id)
         },
         "artisan_info": {
             "name": data.artisan.name,
@@ -125,10 +148,10 @@ async def create_craftid(data: OnboardingData):
             "name": data.art.name,
             "description": data.art.description
         },
-        "original_onboarding_data": data.dict(),
+        "original_onboarding_data": dumped,
         "links": {
-            "track_status": f"/status/{transaction_id}",
-            "shop_listing": f"/shop/{public_id}"
+            "track_status": _TRACK_STATUS_URL.format(tx=transaction_id),
+            "shop_listing": _SHOP_LISTING_URL.format(pid=public_id)
         }
     }
     return response_data
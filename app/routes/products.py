@@ -1,155 +1,207 @@
 # app/routes/products.py
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from typing import List
 import os
+import msgspec
 import hashlib
+import json
 import jwt
+from calendar import timegm
 from datetime import datetime, timedelta
-import asyncio
+from functools import lru_cache
 
-from app.models import OnboardingData
-from app.mongodb import ensure_initialized, collection, next_sequence, close as mongo_close
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout
+
+from app.models import onboarding_decoder
+from app.mongodb import ensure_initialized, collection, craftid_seq, photo_bucket, store_photo, delete_photo
+from app.batcher import craftid_batcher
 
 router = APIRouter()
 SECRET_KEY = os.getenv("SECRET_KEY", "change_in_prod")
 ALGORITHM = "HS256"
 
+# one configured signer for the process; jwt.encode() rebuilds a PyJWS and
+# re-resolves the algorithm class through its registry on every call
+_JWS = jwt.PyJWS()
+_SIGN_KEY = SECRET_KEY.encode()
+
+
+def _today_plus_365() -> datetime:
+    # round to midnight so the expiry (and the cache key below) is stable all day
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today + timedelta(days=365)
+
+
+@lru_cache(maxsize=4096)
+def _encode_jwt(public_id: str) -> str:
+    # signing is compute-bound; cache so retries/duplicate calls skip the HMAC
+    payload = json.dumps(
+        {"public_id": public_id, "exp": timegm(_today_plus_365().utctimetuple())},
+        separators=(",", ":"),
+    ).encode()
+    return _JWS.encode(payload, _SIGN_KEY, algorithm=ALGORITHM)
+
 
 async def ensure_db_ready_or_502():
     try:
         await ensure_initialized()
     except Exception as e:
-        try:
-            mongo_close()
-            await ensure_initialized()
-        except Exception as e2:
-            raise HTTPException(status_code=502, detail=f"DB init error: {e}; retry failed: {e2}")
+        raise HTTPException(status_code=502, detail=f"DB init error: {e}")
+
+
+def _existing_product_response(existing: dict) -> dict:
+    """Build the idempotent add-product response from an already-stored doc."""
+    public_id = existing.get("public_id")
+    public_hash = existing.get("public_hash")
+    verification_url = f"/verify/{public_id}"
+    return {
+        "artisan_info": {
+            "name": existing["original_onboarding_data"]["artisan"]["name"],
+            "location": existing["original_onboarding_data"]["artisan"]["location"]
+        },
+        "art_info": {
+            "name": existing["original_onboarding_data"]["art"]["name"],
+            "description": existing["original_onboarding_data"]["art"]["description"],
+            "photo": existing["original_onboarding_data"]["art"].get("photo", "")
+        },
+        "verification": {
+            "public_id": public_id,
+            "public_hash": public_hash,
+            "verification_url": verification_url
+        },
+        "timestamp": existing.get("timestamp")
+    }
 
 
 @router.post("/add-product")
-async def add_product(data: OnboardingData):
+async def add_product(request: Request):
+    # decode the body with msgspec (C-level parse + validate in one pass)
+    # instead of FastAPI's Pydantic machinery
+    try:
+        data = onboarding_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
     # ensure DB ready
     await ensure_db_ready_or_502()
 
     craftids = collection("craftids")
     art_name_norm = data.art.name.strip().lower()
+    # uniqueness comes from the unique index on art_name_norm; the common
+    # (non-duplicate) path skips the pre-insert find_one entirely
 
+    # allocate from the local id block (one counter round-trip per 100 ids)
     try:
-        existing = await asyncio.wait_for(craftids.find_one({"art_name_norm": art_name_norm}), timeout=4)
-    except asyncio.TimeoutError:
-        raise HTTPException(status_code=504, detail="DB read timed out")
+        seq = await craftid_seq.next()
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="DB sequence allocation timed out")
     except Exception as e:
-        # recovery attempt
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            craftids = collection("craftids")
-            existing = await asyncio.wait_for(craftids.find_one({"art_name_norm": art_name_norm}), timeout=4)
-        except Exception as e2:
-            raise HTTPException(status_code=500, detail=f"DB read error: {e}; recovery: {e2}")
-
-    if existing:
-        public_id = existing.get("public_id")
-        public_hash = existing.get("public_hash")
-        verification_url = f"/verify/{public_id}"
-        return {
-            "artisan_info": {
-                "name": existing["original_onboarding_data"]["artisan"]["name"],
-                "location": existing["original_onboarding_data"]["artisan"]["location"]
-            },
-            "art_info": {
-                "name": existing["original_onboarding_data"]["art"]["name"],
-                "description": existing["original_onboarding_data"]["art"]["description"],
-                "photo": existing["original_onboarding_data"]["art"].get("photo", "")
-            },
-            "verification": {
-                "public_id": public_id,
-                "public_hash": public_hash,
-                "verification_url": verification_url
-            },
-            "timestamp": existing.get("timestamp")
-        }
-
-    # allocate seq
-    try:
-        seq = await asyncio.wait_for(next_sequence("craftid_seq"), timeout=4)
-    except Exception as e:
-        # recovery attempt
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            seq = await asyncio.wait_for(next_sequence("craftid_seq"), timeout=4)
-        except Exception as e2:
-            raise HTTPException(status_code=502, detail=f"Failed to allocate public id: {e}; recovery: {e2}")
+        raise HTTPException(status_code=502, detail=f"Failed to allocate public id: {e}")
 
     public_id = f"CID-{seq:05d}"
-    payload = {"public_id": public_id, "exp": datetime.utcnow() + timedelta(days=365)}
-    private_key = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
-    public_hash = hashlib.sha256((data.art.name + data.art.description + data.art.photo).encode()).hexdigest()
+    private_key = _encode_jwt(public_id)
+    # hash fields incrementally; concatenating first would copy the (possibly
+    # multi-MB) base64 photo twice per request
+    h = hashlib.sha256()
+    h.update(data.art.name.encode())
+    h.update(data.art.description.encode())
+    h.update(data.art.photo.encode())
+    public_hash = h.hexdigest()
+
+    dumped = msgspec.to_builtins(data)
+    # photo goes to GridFS; the doc only stores the /photo/{id} reference
+    photo_ref = await store_photo(data.art.photo)
+    dumped["art"]["photo"] = photo_ref
 
     doc = {
         "public_id": public_id,
         "private_key": private_key,
         "public_hash": public_hash,
         "art_name_norm": art_name_norm,
-        "original_onboarding_data": data.dict(),
+        "original_onboarding_data": dumped,
         "timestamp": datetime.utcnow().isoformat() + "Z"
     }
 
     try:
-        await craftids.insert_one(doc)
+        # batched write: coalesced with concurrent requests into one insert_many
+        await craftid_batcher.submit(doc)
+    except DuplicateKeyError:
+        # the photo was uploaded before the insert; don't leave it orphaned
+        await delete_photo(photo_ref)
+        # idempotent behavior: only pay the extra read when a collision happens
+        existing = await craftids.find_one({"art_name_norm": art_name_norm}, max_time_ms=4000)
+        if existing is None:
+            raise HTTPException(status_code=409, detail="A product with this name already exists.")
+        return _existing_product_response(existing)
     except Exception as e:
-        # recovery retry
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            craftids = collection("craftids")
-            await craftids.insert_one(doc)
-        except Exception as e2:
-            raise HTTPException(status_code=500, detail=f"DB insert error: {e}; recovery: {e2}")
+        raise HTTPException(status_code=500, detail=f"DB insert error: {e}")
 
     verification_url = f"/verify/{public_id}"
     return {
         "artisan_info": {"name": data.artisan.name, "location": data.artisan.location},
-        "art_info": {"name": data.art.name, "description": data.art.description, "photo": data.art.photo},
+        "art_info": {"name": data.art.name, "description": data.art.description, "photo": photo_ref},
         "verification": {"public_id": public_id, "public_hash": public_hash, "verification_url": verification_url},
         "timestamp": doc["timestamp"]
     }
 
 
+@router.get("/photo/{photo_id}")
+async def get_photo(photo_id: str):
+    """Serve an art photo previously stored in GridFS."""
+    await ensure_db_ready_or_502()
+
+    try:
+        oid = ObjectId(photo_id)
+    except InvalidId:
+        raise HTTPException(status_code=404, detail="Photo not found")
+
+    try:
+        stream = await photo_bucket().open_download_stream(oid)
+        contents = await stream.read()
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB read error: {e}")
+
+    mime = (stream.metadata or {}).get("contentType", "application/octet-stream")
+    return Response(content=contents, media_type=mime)
+
+
 @router.get("/get-products")
 async def get_products():
     await ensure_db_ready_or_502()
 
     craftids = collection("craftids")
+    # shape the response server-side: the $project emits docs already in the
+    # output format, so Mongo sends (and we BSON-decode) only what we return
+    # and the Python reshape loop disappears
+    pipeline = [
+        {"$sort": {"timestamp": -1}},
+        {"$limit": 200},
+        {"$project": {
+            "_id": 0,
+            "artisan_info": {
+                "name": {"$ifNull": ["$original_onboarding_data.artisan.name", ""]},
+                "location": {"$ifNull": ["$original_onboarding_data.artisan.location", ""]}
+            },
+            "art_info": {
+                "name": {"$ifNull": ["$original_onboarding_data.art.name", ""]},
+                "description": {"$ifNull": ["$original_onboarding_data.art.description", ""]},
+                "photo": {"$ifNull": ["$original_onboarding_data.art.photo", ""]}
+            },
+            "verification": {
+                "public_id": {"$ifNull": ["$public_id", ""]},
+                "public_hash": {"$ifNull": ["$public_hash", ""]},
+                "verification_url": {"$concat": ["/verify/", {"$ifNull": ["$public_id", ""]}]}
+            },
+            "timestamp": {"$ifNull": ["$timestamp", ""]}
+        }}
+    ]
     try:
-        cursor = craftids.find().sort("timestamp", -1)
-        docs = await cursor.to_list(length=200)
+        cursor = await craftids.aggregate(pipeline)
+        return await cursor.to_list(length=200)
     except Exception as e:
-        # recovery attempt
-        try:
-            mongo_close()
-            await ensure_db_ready_or_502()
-            craftids = collection("craftids")
-            cursor = craftids.find().sort("timestamp", -1)
-            docs = await cursor.to_list(length=200)
-        except Exception as e2:
-            raise HTTPException(status_code=500, detail=f"DB read error: {e}; recovery: {e2}")
-
-    out = []
-    for d in docs:
-        orig = d.get("original_onboarding_data", {})
-        artisan = orig.get("artisan", {})
-        art = orig.get("art", {})
-        public_id = d.get("public_id")
-        public_hash = d.get("public_hash")
-        verification_url = f"/verify/{public_id}" if public_id else ""
-
-        out.append({
-            "artisan_info": {"name": artisan.get("name", ""), "location": artisan.get("location", "")},
-            "art_info": {"name": art.get("name", ""), "description": art.get("description", ""), "photo": art.get("photo", "")},
-            "verification": {"public_id": public_id or "", "public_hash": public_hash or "", "verification_url": verification_url},
-            "timestamp": d.get("timestamp", "")
-        })
-
-    return out
+        raise HTTPException(status_code=500, detail=f"DB read error: {e}")